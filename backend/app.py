@@ -7,20 +7,32 @@ Combines three AI systems:
 """
 
 import os
+import re
+import sys
+import asyncio
 import uuid
 import base64
-from typing import Dict, Optional, List
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, FrozenSet, Optional, List, Tuple
 from datetime import datetime
 import logging
 import io
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import JSONResponse
+import orjson
+from cachetools import Cache, LRUCache, TTLCache
+
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field
 import uvicorn
-import google.generativeai as genai
-from PIL import Image
+
+# Gemini SDK and Pillow are imported lazily (see _genai / _pil) to keep cold starts light
+if TYPE_CHECKING:
+    import google.generativeai as genai
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -30,94 +42,457 @@ logger = logging.getLogger(__name__)
 from dotenv import load_dotenv
 load_dotenv()
 
+# Read once; rotating the key requires a restart anyway
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+if not GOOGLE_API_KEY:
+    raise RuntimeError("GOOGLE_API_KEY is not set. Please configure it in .env or the environment.")
+
 # Initialize FastAPI app
+# Routes declare response models so FastAPI serializes straight to JSON bytes via Pydantic
 app = FastAPI(title="Integrated Medical AI System", version="1.0")
 
 # CORS Configuration
+# ALLOWED_ORIGINS is a comma-separated list; unset keeps the permissive default
+ALLOWED_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, specify exact origins
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# Compress large responses (multi-KB Gemini answers); small payloads pass through
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Create necessary directories
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # ==================== Models ====================
+MAX_INPUT_CHARS = 8000  # Hard limit on the new message; prompts are trimmed further to MAX_MSG_CHARS
+# History echoes assistant replies back, so its caps sit far above anything
+# Gemini returns (~32k chars at 8192 output tokens); they only bound parsing
+MAX_HISTORY_CONTENT_CHARS = 100_000
+MAX_HISTORY_ITEMS = 50  # The frontend sends at most MAX_HISTORY_MSGS + HISTORY_TRIM_STEP - 1
+
 class ChatMessage(BaseModel):
     role: str
-    content: str
+    content: str = Field(..., max_length=MAX_HISTORY_CONTENT_CHARS)  # Trimmed to MAX_MSG_CHARS for prompts
     timestamp: str
     agent: Optional[str] = None
 
 class ChatRequest(BaseModel):
-    message: str
-    history: List[ChatMessage]
+    message: str = Field(..., max_length=MAX_INPUT_CHARS)
+    history: List[ChatMessage] = Field(..., max_length=MAX_HISTORY_ITEMS)
     image: Optional[str] = None  # Base64 encoded
     agent_type: Optional[str] = "auto"  # auto, medical-chat, prescription, multi-agent
 
+MAX_BATCH_ITEMS = 16  # Keeps one batch from exhausting the Gemini concurrency quota
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+
 class PrescriptionParseRequest(BaseModel):
     image: str  # Base64 encoded
 
 class VoiceCommandRequest(BaseModel):
     text: str
 
+class AgentResponse(BaseModel):
+    """Result envelope shared by the agent endpoints; routes omit unset fields"""
+    success: Optional[bool] = None
+    response: Optional[str] = None
+    error: Optional[str] = None
+    agent: Optional[str] = None
+    source: Optional[str] = None
+    requires_validation: Optional[bool] = None
+    data: Optional[Any] = None
+
+class BatchChatResult(AgentResponse):
+    status_code: int
+
+class BatchChatResponse(BaseModel):
+    results: List[BatchChatResult]
+
+# ==================== Response Cache ====================
+
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+# Namespaces whose answers go stale; others live until LRU eviction
+RESPONSE_CACHE_TTLS = {"web-search": 900}  # Seconds
+RESPONSE_CACHE_CONTEXT_WINDOW = 4  # History messages folded into the cache key
+PARSE_CACHE_MAX_ENTRIES = 512
+PARSE_CACHE_TTL = 3600  # Seconds
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Lowercase and collapse whitespace.
+
+    Punctuation is kept: "1.5 mg" vs "15 mg" or "1/2 tablet" vs "12 tablet"
+    must never share a cache entry or an in-flight call.
+    """
+    return _WHITESPACE_RE.sub(" ", text.lower()).strip()
+
+
+def history_tail_hash(history: List[ChatMessage], window: int = RESPONSE_CACHE_CONTEXT_WINDOW) -> str:
+    """Hash the last few history messages so cached answers stay in context"""
+    digest = hashlib.sha256()
+    for msg in history[-window:] if window else []:
+        digest.update(f"{msg.role}\x00{normalize_prompt(trim_message(msg.content))}\x00".encode())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """In-memory LRU cache for Gemini results.
+
+    Entries are keyed by ``(namespace, context, normalized prompt)`` and only
+    exact matches hit: near-identical medical questions ("500mg" vs "5000mg")
+    can need different answers. Namespaces listed in ``ttls`` get their own
+    TTLCache so time-sensitive answers expire.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttls: Dict[str, int] = RESPONSE_CACHE_TTLS):
+        self._entries: Cache = LRUCache(maxsize=max_entries)
+        self._expiring: Dict[str, Cache] = {
+            namespace: TTLCache(maxsize=max_entries, ttl=ttl)
+            for namespace, ttl in ttls.items()
+        }
+
+    def _store(self, namespace: str) -> Cache:
+        return self._expiring.get(namespace, self._entries)
+
+    def get(self, namespace: str, key: str, context: str = "") -> Optional[Any]:
+        return self._store(namespace).get((namespace, context, key))
+
+    def set(self, namespace: str, key: str, value: Any, context: str = "") -> None:
+        self._store(namespace)[(namespace, context, key)] = value
+
+
+# Free-text answers are keyed by normalized prompt. Image and JSON results are
+# content-addressed by (agent, sha256 of input) and expire after PARSE_CACHE_TTL.
+response_cache = ResponseCache()
+parse_cache: TTLCache = TTLCache(maxsize=PARSE_CACHE_MAX_ENTRIES, ttl=PARSE_CACHE_TTL)
+
+# ==================== Prompts ====================
+# Static instructions are sent as the model's system instruction so the prefix
+# stays byte-identical across requests; only the user turn varies.
+
+MEDICAL_SYSTEM_PROMPT = """You are a professional Medical AI Assistant. Provide accurate, empathetic medical information. Always include disclaimers that this is not a substitute for professional medical advice."""
+
+PRESCRIPTION_SYSTEM_PROMPT = """Analyze this prescription image and extract the following information in JSON format:
+{
+    "medications": [
+        {
+            "name": "medication name",
+            "quantity": number,
+            "dose": "dosage",
+            "frequency": "frequency",
+            "confidence": 0.9
+        }
+    ],
+    "patient": {
+        "name": "patient name or null",
+        "dob": "date of birth or null"
+    },
+    "doctor": {
+        "name": "doctor name or null"
+    },
+    "date": "prescription date or null",
+    "human_review_required": false
+}
+
+Be thorough and accurate. If text is unclear, indicate lower confidence."""
+
+RAG_SYSTEM_PROMPT = """You are a medical knowledge expert with access to medical databases. Answer the user's query.
+
+Provide accurate, evidence-based information with sources when possible."""
+
+WEB_SEARCH_SYSTEM_PROMPT = """Search for and provide the latest information about the user's query.
+
+Focus on recent research, clinical trials, and medical news."""
+
+IMAGE_ANALYSIS_SYSTEM_PROMPT = """You are a medical imaging specialist. Analyze the provided image in the context of the user's query.
+
+Provide detailed analysis including:
+- What type of medical image this is
+- Key observations
+- Potential findings
+- Recommendations
+
+IMPORTANT: Include appropriate medical disclaimers."""
+
+VOICE_COMMAND_SYSTEM_PROMPT = """Parse the user's voice command for a medical prescription order system.
+
+Return JSON with:
+{
+    "intent": "add" | "remove" | "confirm" | "done" | "unknown",
+    "medication_name": "name or null",
+    "quantity": number or null,
+    "confidence": 0.8
+}"""
+
+# Gemini usually wraps JSON replies in a markdown code fence
+_CODEFENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+JSON_PARSE_CACHE_SIZE = 1024
+
+
+def _parse_json_response(raw: str) -> Dict:
+    """Parse the JSON object from a Gemini reply, with or without a code fence"""
+    match = _CODEFENCE_RE.search(raw)
+    return orjson.loads(match.group(1) if match else raw)
+
+# Voice command replies repeat often; cached results are shared, so treat them as read-only
+_parse_json_response_cached = lru_cache(maxsize=JSON_PARSE_CACHE_SIZE)(_parse_json_response)
+
+
+MAX_HISTORY_MSGS = 10
+MAX_MSG_CHARS = 4000  # Per-message cap; prefill cost grows with prompt length
+HISTORY_TRIM_STEP = 5  # Old messages are dropped in blocks of this size
+
+
+def trim_message(text: str) -> str:
+    """Keep the last MAX_MSG_CHARS characters of a message"""
+    return text[-MAX_MSG_CHARS:]
+
+
+def history_window(history: List[ChatMessage]) -> List[ChatMessage]:
+    """Return at most MAX_HISTORY_MSGS of recent history with a stable start.
+
+    Sliding the window one message per turn would change the first content
+    on every request. Trimming in blocks keeps the prompt prefix identical
+    for HISTORY_TRIM_STEP consecutive turns so Gemini's prefix cache can hit.
+    Prefix stability depends on the client: the frontend applies the same
+    window before sending (historyWindow in App.tsx); this guards other callers.
+    """
+    overflow = max(0, len(history) - MAX_HISTORY_MSGS)
+    start = -(-overflow // HISTORY_TRIM_STEP) * HISTORY_TRIM_STEP
+    return history[start:]
+
+
+def build_contents(history: List[ChatMessage], message: str) -> List[Dict]:
+    """Convert chat history into Gemini ``contents``, ending with the new user turn"""
+    contents = [
+        {"role": "model" if msg.role == "assistant" else "user", "parts": [trim_message(msg.content)]}
+        for msg in history_window(history)
+    ]
+    contents.append({"role": "user", "parts": [message]})
+    return contents
+
+# ==================== Gemini Models ====================
+# The SDK is imported and configured on first use, so health checks on a cold
+# start never load it. Model instances are shared across requests.
+
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+
+
+@lru_cache(maxsize=1)
+def _genai():
+    """Import and configure the Gemini SDK once"""
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai
+
+
+@lru_cache(maxsize=None)
+def get_model(system_instruction: str) -> "genai.GenerativeModel":
+    """Return the shared GenerativeModel for a system prompt"""
+    return _genai().GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_instruction)
+
+
+# In-flight Gemini calls keyed by request; concurrent duplicates await the same future
+_inflight: Dict[str, "asyncio.Future[Any]"] = {}
+
+
+async def singleflight(key: str, coro_factory: Callable[[], Awaitable[Any]]) -> Any:
+    """Run coro_factory once per key, sharing its result with concurrent callers"""
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(coro_factory())
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shield so one caller disconnecting does not cancel the call for the others
+    return await asyncio.shield(future)
+
+
+async def generate_text(model: "genai.GenerativeModel", contents: Any, namespace: str, cache_key: str, cache_context: str = "") -> str:
+    """Return a Gemini text reply, served from the response cache when possible"""
+    cached = response_cache.get(namespace, cache_key, cache_context)
+    if cached is not None:
+        return cached
+    
+    async def call() -> str:
+        response = await model.generate_content_async(contents)
+        response_cache.set(namespace, cache_key, response.text, cache_context)
+        return response.text
+    
+    flight_key = hashlib.sha1(f"{namespace}\x00{cache_context}\x00{cache_key}".encode()).hexdigest()
+    return await singleflight(flight_key, call)
+
+
+async def stream_response(model: "genai.GenerativeModel", contents: Any, namespace: str, cache_key: str, cache_context: str = "") -> AsyncIterator[str]:
+    """Yield Gemini text chunks as they arrive and cache the complete reply"""
+    cached = response_cache.get(namespace, cache_key, cache_context)
+    if cached is not None:
+        yield cached
+        return
+    
+    response = await model.generate_content_async(contents, stream=True)
+    chunks = []
+    async for chunk in response:
+        chunks.append(chunk.text)
+        yield chunk.text
+    response_cache.set(namespace, cache_key, "".join(chunks), cache_context)
+
+
+def decode_base64_image(image: str) -> bytes:
+    """Decode a base64 image string, with or without a data URL prefix"""
+    # Remove data URL prefix if present
+    if "," in image:
+        image = image.split(",")[1]
+    return base64.b64decode(image)
+
+
+IMAGE_MAX_SIZE = (1600, 1600)
+PRESCRIPTION_IMAGE_MAX_SIZE = (2000, 2000)  # Keep fine print legible
+IMAGE_JPEG_QUALITY = 85
+# JPEG metadata that can carry GPS/device details; uploads with any of it are
+# re-encoded (which drops it) rather than forwarded to Gemini as-is
+IMAGE_METADATA_KEYS = ("exif", "xmp", "photoshop", "comment")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Dedicated pool so large uploads cannot starve the default to_thread executor
+_image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-decode")
+
+
+@lru_cache(maxsize=1)
+def _pil():
+    """Import Pillow on first use"""
+    from PIL import Image, ImageOps
+    return Image, ImageOps
+
+
+def prepare_image(image_bytes: bytes, max_size: Tuple[int, int] = IMAGE_MAX_SIZE) -> Dict:
+    """Return an inline JPEG blob for Gemini, downscaling and re-encoding only when needed"""
+    Image, ImageOps = _pil()
+    pil_image = Image.open(io.BytesIO(image_bytes))  # Lazy: only the header is parsed here
+    
+    # A small JPEG with no metadata is already what Gemini needs; send the original bytes
+    if (
+        pil_image.format == "JPEG"
+        and pil_image.mode in ("RGB", "L")
+        and pil_image.width <= max_size[0]
+        and pil_image.height <= max_size[1]
+        and not any(key in pil_image.info for key in IMAGE_METADATA_KEYS)
+    ):
+        return {"mime_type": "image/jpeg", "data": image_bytes}
+    
+    pil_image.draft("RGB", max_size)  # Let libjpeg decode large JPEGs at reduced scale
+    pil_image = ImageOps.exif_transpose(pil_image)  # Re-encoding drops the EXIF orientation tag
+    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)  # Only ever shrinks
+    if pil_image.mode not in ("RGB", "L"):
+        pil_image = pil_image.convert("RGB")
+    # thumbnail/exif_transpose keep .info and the JPEG encoder writes info["comment"] back out
+    for key in IMAGE_METADATA_KEYS:
+        pil_image.info.pop(key, None)
+    
+    buf = io.BytesIO()
+    pil_image.save(buf, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=False)
+    data = buf.getvalue()
+    if any(key in Image.open(io.BytesIO(data)).info for key in IMAGE_METADATA_KEYS):
+        raise ValueError("Re-encoded image still carries metadata")
+    return {"mime_type": "image/jpeg", "data": data}
+
+
+async def load_image_part(image_bytes: bytes, max_size: Tuple[int, int] = IMAGE_MAX_SIZE) -> Dict:
+    """Run prepare_image on the image pool, keeping the event loop free"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_image_executor, prepare_image, image_bytes, max_size)
+
+# ==================== Routing ====================
+# Intent keywords keep the original substring semantics (no word boundaries).
+
+INTENT_KEYWORDS = {
+    "prescription": ["prescription", "medication list", "parse prescription"],
+    "multi-agent": ["research", "latest", "study", "analyze image", "x-ray", "scan"],
+    "image-analysis": ["analyze image", "x-ray", "scan", "mri", "ct scan", "tumor", "lesion"],
+    "web-search": ["latest", "recent", "news", "research", "study", "2024", "2025", "current"],
+}
+INTENT_CACHE_SIZE = 4096
+INTENT_CACHE_MAX_CHARS = 512  # Longer messages are classified without caching
+
+# Each keyword maps to every intent whose keywords it contains, so a longer
+# match (e.g. "ct scan") also reports the intents of the keywords inside it
+_KEYWORD_INTENTS = {
+    keyword: frozenset(
+        intent for intent, words in INTENT_KEYWORDS.items()
+        if any(word in keyword for word in words)
+    )
+    for keywords in INTENT_KEYWORDS.values()
+    for keyword in keywords
+}
+# Zero-width lookahead tries every start position, so overlapping keywords are
+# all seen in one pass; longest-first alternation covers keywords sharing a start.
+# Matching runs on message.lower() rather than with re.IGNORECASE, which also
+# folds characters like U+017F that lower() leaves alone.
+_INTENT_RE = re.compile(
+    "(?=(" + "|".join(re.escape(word) for word in sorted(_KEYWORD_INTENTS, key=len, reverse=True)) + "))"
+)
+
+
+def _classify_intent(message: str) -> FrozenSet[str]:
+    intents: FrozenSet[str] = frozenset()
+    for match in _INTENT_RE.finditer(message.lower()):
+        intents |= _KEYWORD_INTENTS[match.group(1)]
+    return intents
+
+_classify_intent_cached = lru_cache(maxsize=INTENT_CACHE_SIZE)(_classify_intent)
+
+
+def classify_intent(message: str) -> FrozenSet[str]:
+    """Return the routing intents whose keywords appear in the message"""
+    if len(message) > INTENT_CACHE_MAX_CHARS:
+        return _classify_intent(message)
+    return _classify_intent_cached(message)
+
 # ==================== Agent Integrations ====================
 
 class MedicalConversationAgent:
     """Handles general medical conversations using Gemini"""
     
-    def __init__(self):
-        self.api_key = os.getenv("GOOGLE_API_KEY")
-        if self.api_key:
-            genai.configure(api_key=self.api_key)
+    @property
+    def model(self) -> "genai.GenerativeModel":
+        return get_model(MEDICAL_SYSTEM_PROMPT)
         
-    async def process(self, message: str, history: List[ChatMessage], image: Optional[str] = None) -> Dict:
+    async def process(self, message: str, history: List[ChatMessage], image_bytes: Optional[bytes] = None) -> Dict:
         try:
-            if not self.api_key:
-                return {
-                    "success": False,
-                    "error": "API Key missing",
-                    "response": "API Key is missing. Please configure GOOGLE_API_KEY."
-                }
+            message = trim_message(message)
             
             # Use vision model if image provided
-            if image:
-                # Remove data URL prefix if present
-                if "," in image:
-                    image_data = image.split(",")[1]
-                else:
-                    image_data = image
-                
-                # Decode base64 image
-                image_bytes = base64.b64decode(image_data)
-                pil_image = Image.open(io.BytesIO(image_bytes))
+            if image_bytes:
+                image_part = await load_image_part(image_bytes)
                 
-                model = genai.GenerativeModel('gemini-2.0-flash')
-                prompt = f"""You are a professional Medical AI Assistant. Analyze this image and respond to: {message}
-                
-Provide accurate, empathetic medical information. Always include disclaimers that this is not a substitute for professional medical advice."""
-                
-                response = model.generate_content([prompt, pil_image])
+                response = await self.model.generate_content_async([f"Analyze this image and respond to: {message}", image_part])
+                response_text = response.text
             else:
                 # Text-only conversation
-                model = genai.GenerativeModel('gemini-2.0-flash')
-                
-                # Build prompt with history
-                full_prompt = "You are a professional Medical AI Assistant. Provide accurate, empathetic medical information. Always include disclaimers that this is not a substitute for professional medical advice.\n\n"
-                
-                for msg in history[-10:]:  # Last 10 messages
-                    full_prompt += f"{msg.role}: {msg.content}\n"
-                full_prompt += f"user: {message}\nassistant:"
-                
-                response = model.generate_content(full_prompt)
+                response_text = await generate_text(
+                    self.model,
+                    build_contents(history, message),
+                    "medical-chat",
+                    normalize_prompt(message),
+                    history_tail_hash(history),
+                )
             
             return {
                 "success": True,
-                "response": response.text,
+                "response": response_text,
                 "agent": "Medical Conversation Agent",
                 "requires_validation": False
             }
@@ -129,78 +504,49 @@ Provide accurate, empathetic medical information. Always include disclaimers tha
                 "error": str(e),
                 "response": "I apologize, but I encountered an error processing your request. Please try again."
             }
+    
+    async def stream(self, message: str, history: List[ChatMessage]) -> AsyncIterator[str]:
+        """Stream a text-only conversation reply chunk by chunk"""
+        message = trim_message(message)
+        async for text in stream_response(
+            self.model,
+            build_contents(history, message),
+            "medical-chat",
+            normalize_prompt(message),
+            history_tail_hash(history),
+        ):
+            yield text
 
 
 class PrescriptionParserAgent:
     """Handles prescription image parsing"""
     
-    def __init__(self):
-        self.api_key = os.getenv("GOOGLE_API_KEY")
-        if self.api_key:
-            genai.configure(api_key=self.api_key)
+    @property
+    def model(self) -> "genai.GenerativeModel":
+        return get_model(PRESCRIPTION_SYSTEM_PROMPT)
     
-    async def process(self, image: str) -> Dict:
+    async def process(self, image_bytes: bytes) -> Dict:
         try:
-            if not self.api_key:
-                return {
-                    "success": False,
-                    "error": "API Key missing",
-                    "response": "API Key is missing."
-                }
+            cache_key = ("prescription", hashlib.sha256(image_bytes).hexdigest())
+            cached = parse_cache.get(cache_key)
+            if cached is not None:
+                return cached
             
-            # Remove data URL prefix if present
-            if "," in image:
-                image_data = image.split(",")[1]
-            else:
-                image_data = image
-            
-            # Decode base64 image
-            image_bytes = base64.b64decode(image_data)
-            pil_image = Image.open(io.BytesIO(image_bytes))
+            image_part = await load_image_part(image_bytes, PRESCRIPTION_IMAGE_MAX_SIZE)
             
-            prompt = """Analyze this prescription image and extract the following information in JSON format:
-            {
-                "medications": [
-                    {
-                        "name": "medication name",
-                        "quantity": number,
-                        "dose": "dosage",
-                        "frequency": "frequency",
-                        "confidence": 0.9
-                    }
-                ],
-                "patient": {
-                    "name": "patient name or null",
-                    "dob": "date of birth or null"
-                },
-                "doctor": {
-                    "name": "doctor name or null"
-                },
-                "date": "prescription date or null",
-                "human_review_required": false
-            }
-            
-            Be thorough and accurate. If text is unclear, indicate lower confidence."""
-            
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            response = model.generate_content([prompt, pil_image])
+            response = await self.model.generate_content_async([image_part])
             
             # Parse JSON from response
-            import json
-            result_text = response.text.strip()
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0]
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0]
-            
-            result = json.loads(result_text)
+            result = _parse_json_response(response.text)
             
-            return {
+            parsed = {
                 "success": True,
                 "data": result,
                 "agent": "Prescription Parser",
                 "response": f"Successfully parsed prescription. Found {len(result.get('medications', []))} medication(s)."
             }
+            parse_cache[cache_key] = parsed
+            return parsed
             
         except Exception as e:
             logger.error(f"Prescription parsing error: {e}")
@@ -214,32 +560,26 @@ class PrescriptionParserAgent:
 class MultiAgentSystem:
     """Integrates RAG, Web Search, and Image Analysis agents"""
     
-    def __init__(self):
-        self.api_key = os.getenv("GOOGLE_API_KEY")
-        if self.api_key:
-            genai.configure(api_key=self.api_key)
+    @property
+    def rag_model(self) -> "genai.GenerativeModel":
+        return get_model(RAG_SYSTEM_PROMPT)
+    
+    @property
+    def web_search_model(self) -> "genai.GenerativeModel":
+        return get_model(WEB_SEARCH_SYSTEM_PROMPT)
+    
+    @property
+    def image_model(self) -> "genai.GenerativeModel":
+        return get_model(IMAGE_ANALYSIS_SYSTEM_PROMPT)
         
-    async def process(self, message: str, history: List[ChatMessage], image: Optional[str] = None) -> Dict:
+    async def process(self, message: str, history: List[ChatMessage], image_bytes: Optional[bytes] = None) -> Dict:
         try:
-            if not self.api_key:
-                return {
-                    "success": False,
-                    "error": "API Key missing",
-                    "response": "API Key is missing."
-                }
-            
-            # Determine which agent to route to based on query
-            query_lower = message.lower()
-            
-            # Check if it's an image analysis request
-            if image or any(word in query_lower for word in ["analyze image", "x-ray", "scan", "mri", "ct scan", "tumor", "lesion"]):
-                return await self._handle_image_analysis(message, image)
-            
-            # Check if it needs web search
-            if any(word in query_lower for word in ["latest", "recent", "news", "research", "study", "2024", "2025", "current"]):
+            message = trim_message(message)
+            route = self.route(message, bool(image_bytes))
+            if route == "image-analysis":
+                return await self._handle_image_analysis(message, image_bytes)
+            if route == "web-search":
                 return await self._handle_web_search(message)
-            
-            # Default to RAG
             return await self._handle_rag(message)
             
         except Exception as e:
@@ -250,17 +590,43 @@ class MultiAgentSystem:
                 "response": "I encountered an error processing your request with the multi-agent system."
             }
     
+    async def stream(self, message: str) -> AsyncIterator[str]:
+        """Stream a text-only RAG or web search reply chunk by chunk"""
+        message = trim_message(message)
+        route = self.route(message, False)
+        if route == "image-analysis":
+            raise ValueError("Image analysis requires an image; use /api/chat")
+        
+        if route == "web-search":
+            model, namespace = self.web_search_model, "web-search"
+        else:
+            model, namespace = self.rag_model, "rag"
+        async for text in stream_response(model, message, namespace, normalize_prompt(message)):
+            yield text
+    
+    def route(self, message: str, has_image: bool) -> str:
+        """Determine which agent to route to based on query"""
+        intents = classify_intent(message)
+        
+        # Check if it's an image analysis request
+        if has_image or "image-analysis" in intents:
+            return "image-analysis"
+        
+        # Check if it needs web search
+        if "web-search" in intents:
+            return "web-search"
+        
+        # Default to RAG
+        return "rag"
+    
     async def _handle_rag(self, query: str) -> Dict:
         """Handle RAG-based queries"""
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            response = model.generate_content(f"""As a medical knowledge expert with access to medical databases, answer this query: {query}
-                
-Provide accurate, evidence-based information with sources when possible.""")
+            response_text = await generate_text(self.rag_model, query, "rag", normalize_prompt(query))
             
             return {
                 "success": True,
-                "response": response.text,
+                "response": response_text,
                 "agent": "Medical RAG Agent",
                 "source": "Medical Knowledge Base"
             }
@@ -271,14 +637,11 @@ Provide accurate, evidence-based information with sources when possible.""")
     async def _handle_web_search(self, query: str) -> Dict:
         """Handle web search queries"""
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            response = model.generate_content(f"""Search for and provide the latest information about: {query}
-                
-Focus on recent research, clinical trials, and medical news.""")
+            response_text = await generate_text(self.web_search_model, query, "web-search", normalize_prompt(query))
             
             return {
                 "success": True,
-                "response": response.text,
+                "response": response_text,
                 "agent": "Web Search Agent",
                 "source": "Web Search"
             }
@@ -287,44 +650,32 @@ Focus on recent research, clinical trials, and medical news.""")
             # Fallback to regular response
             return await self._handle_rag(query)
     
-    async def _handle_image_analysis(self, query: str, image: Optional[str]) -> Dict:
+    async def _handle_image_analysis(self, query: str, image_bytes: Optional[bytes]) -> Dict:
         """Handle medical image analysis"""
         try:
-            if not image:
+            if not image_bytes:
                 return {
                     "success": False,
                     "response": "Please provide an image for analysis."
                 }
             
-            # Remove data URL prefix if present
-            if "," in image:
-                image_data = image.split(",")[1]
-            else:
-                image_data = image
+            cache_key = ("image-analysis", hashlib.sha256(image_bytes).hexdigest(), normalize_prompt(query))
+            cached = parse_cache.get(cache_key)
+            if cached is not None:
+                return cached
             
-            # Decode base64 image
-            image_bytes = base64.b64decode(image_data)
-            pil_image = Image.open(io.BytesIO(image_bytes))
+            image_part = await load_image_part(image_bytes)
             
-            prompt = f"""As a medical imaging specialist, analyze this image. User query: {query}
-                    
-Provide detailed analysis including:
-- What type of medical image this is
-- Key observations
-- Potential findings
-- Recommendations
-
-IMPORTANT: Include appropriate medical disclaimers."""
+            response = await self.image_model.generate_content_async([f"User query: {query}", image_part])
             
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            response = model.generate_content([prompt, pil_image])
-            
-            return {
+            result = {
                 "success": True,
                 "response": response.text,
                 "agent": "Medical Image Analysis Agent",
                 "requires_validation": True
             }
+            parse_cache[cache_key] = result
+            return result
             
         except Exception as e:
             logger.error(f"Image analysis error: {e}")
@@ -339,7 +690,7 @@ multi_agent_system = MultiAgentSystem()
 # ==================== API Routes ====================
 
 @app.get("/")
-async def root():
+async def root() -> Dict[str, Any]:
     return {
         "message": "Integrated Medical AI System",
         "version": "1.0",
@@ -350,117 +701,190 @@ async def root():
         ]
     }
 
-@app.post("/api/chat")
-async def chat(request: ChatRequest):
-    """Main chat endpoint that routes to appropriate agent"""
+def detect_agent_type(message: str, has_image: bool) -> str:
+    """Auto-detect the agent type for a chat message"""
+    intents = classify_intent(message)
+    
+    # Check for prescription-related keywords
+    if has_image and "prescription" in intents:
+        return "prescription"
+    # Check for advanced queries
+    if "multi-agent" in intents:
+        return "multi-agent"
+    return "medical-chat"
+
+async def dispatch_chat(message: str, history: List[ChatMessage], image_bytes: Optional[bytes], agent_type: Optional[str]) -> Tuple[int, Dict]:
+    """Route a chat message to the appropriate agent, returning (status code, content)"""
     try:
         # Auto-detect agent type if not specified
-        if request.agent_type == "auto":
-            message_lower = request.message.lower()
-            
-            # Check for prescription-related keywords
-            if any(word in message_lower for word in ["prescription", "medication list", "parse prescription"]) and request.image:
-                request.agent_type = "prescription"
-            # Check for advanced queries
-            elif any(word in message_lower for word in ["research", "latest", "study", "analyze image", "x-ray", "scan"]):
-                request.agent_type = "multi-agent"
-            else:
-                request.agent_type = "medical-chat"
+        if agent_type == "auto":
+            agent_type = detect_agent_type(message, bool(image_bytes))
         
         # Route to appropriate agent
-        if request.agent_type == "medical-chat":
-            result = await medical_chat_agent.process(request.message, request.history, request.image)
-        elif request.agent_type == "prescription":
-            if not request.image:
-                return JSONResponse(
-                    status_code=400,
-                    content={"error": "Image required for prescription parsing"}
-                )
-            result = await prescription_agent.process(request.image)
-        elif request.agent_type == "multi-agent":
-            result = await multi_agent_system.process(request.message, request.history, request.image)
+        if agent_type == "medical-chat":
+            result = await medical_chat_agent.process(message, history, image_bytes)
+        elif agent_type == "prescription":
+            if not image_bytes:
+                return 400, {"error": "Image required for prescription parsing"}
+            result = await prescription_agent.process(image_bytes)
+        elif agent_type == "multi-agent":
+            result = await multi_agent_system.process(message, history, image_bytes)
         else:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Invalid agent type"}
-            )
+            return 400, {"error": "Invalid agent type"}
         
-        return JSONResponse(content=result)
+        return 200, result
         
     except Exception as e:
         logger.error(f"Chat error: {e}")
+        return 500, {
+            "success": False,
+            "error": str(e),
+            "response": "An unexpected error occurred. Please try again."
+        }
+
+async def dispatch_chat_request(request: ChatRequest) -> Tuple[int, Dict]:
+    """Decode a JSON chat request's image and dispatch it"""
+    try:
+        image_bytes = decode_base64_image(request.image) if request.image else None
+    except ValueError as e:
+        return 400, {"success": False, "error": f"Invalid image data: {e}"}
+    return await dispatch_chat(request.message, request.history, image_bytes, request.agent_type)
+
+@app.post("/api/chat", response_model=AgentResponse, response_model_exclude_unset=True)
+async def chat(request: ChatRequest, response: Response):
+    """Main chat endpoint that routes to appropriate agent"""
+    response.status_code, content = await dispatch_chat_request(request)
+    return content
+
+@app.post("/api/chat/batch", response_model=BatchChatResponse, response_model_exclude_unset=True)
+async def chat_batch(request: BatchChatRequest):
+    """Answer several chat requests concurrently"""
+    if not 0 < len(request.items) <= MAX_BATCH_ITEMS:
         return JSONResponse(
-            status_code=500,
-            content={
-                "success": False,
-                "error": str(e),
-                "response": "An unexpected error occurred. Please try again."
-            }
+            status_code=400,
+            content={"error": f"Batch must contain between 1 and {MAX_BATCH_ITEMS} items"}
         )
+    
+    outcomes = await asyncio.gather(
+        *(dispatch_chat_request(item) for item in request.items),
+        return_exceptions=True
+    )
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            logger.error(f"Batch chat error: {outcome}")
+            outcome = 500, {"success": False, "error": str(outcome)}
+        status_code, content = outcome
+        results.append({"status_code": status_code, **content})
+    return {"results": results}
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Stream text chat replies as server-sent events"""
+    agent_type = request.agent_type
+    if agent_type == "auto":
+        agent_type = detect_agent_type(request.message, bool(request.image))
+    
+    # Image and prescription requests need a complete response; use /api/chat
+    if request.image or agent_type not in ("medical-chat", "multi-agent"):
+        return JSONResponse(
+            status_code=400,
+            content={"error": "Streaming is only available for text chat"}
+        )
+    if agent_type == "multi-agent" and multi_agent_system.route(trim_message(request.message), False) == "image-analysis":
+        return JSONResponse(
+            status_code=400,
+            content={"error": "Please provide an image for analysis."}
+        )
+    
+    if agent_type == "medical-chat":
+        chunks = medical_chat_agent.stream(request.message, request.history)
+    else:
+        chunks = multi_agent_system.stream(request.message)
+    
+    async def events():
+        try:
+            async for text in chunks:
+                yield f"data: {orjson.dumps({'delta': text}).decode()}\n\n"
+            yield f"data: {orjson.dumps({'done': True}).decode()}\n\n"
+        except Exception as e:
+            logger.error(f"Chat stream error: {e}")
+            yield f"data: {orjson.dumps({'error': str(e)}).decode()}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
 
-@app.post("/api/prescription/parse")
-async def parse_prescription(request: PrescriptionParseRequest):
+@app.post("/api/chat-multipart", response_model=AgentResponse, response_model_exclude_unset=True)
+async def chat_multipart(
+    response: Response,
+    message: str = Form(..., max_length=MAX_INPUT_CHARS),
+    history: str = Form("[]"),  # JSON encoded list of ChatMessage
+    agent_type: str = Form("auto"),
+    image: Optional[UploadFile] = File(None),
+):
+    """Chat endpoint accepting a raw image upload instead of base64"""
+    try:
+        raw_history = orjson.loads(history)
+        if len(raw_history) > MAX_HISTORY_ITEMS:
+            raise ValueError(f"at most {MAX_HISTORY_ITEMS} messages allowed")
+        chat_history = [ChatMessage(**msg) for msg in raw_history]
+    except (ValueError, TypeError) as e:
+        response.status_code = 400
+        return {"success": False, "error": f"Invalid history: {e}"}
+    image_bytes = await image.read() if image else None
+    response.status_code, content = await dispatch_chat(message, chat_history, image_bytes, agent_type)
+    return content
+
+@app.post("/api/prescription/parse", response_model=AgentResponse, response_model_exclude_unset=True)
+async def parse_prescription(request: PrescriptionParseRequest, response: Response):
     """Dedicated endpoint for prescription parsing"""
     try:
-        result = await prescription_agent.process(request.image)
-        return JSONResponse(content=result)
+        result = await prescription_agent.process(decode_base64_image(request.image))
+        return result
     except Exception as e:
         logger.error(f"Prescription parse error: {e}")
-        return JSONResponse(
-            status_code=500,
-            content={"success": False, "error": str(e)}
-        )
+        response.status_code = 500
+        return {"success": False, "error": str(e)}
 
-@app.post("/api/voice/command")
-async def voice_command(request: VoiceCommandRequest):
-    """Process voice commands for prescription ordering"""
+@app.post("/api/prescription/parse-multipart", response_model=AgentResponse, response_model_exclude_unset=True)
+async def parse_prescription_multipart(response: Response, image: UploadFile = File(...)):
+    """Prescription parsing from a raw image upload"""
     try:
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            return JSONResponse(
-                status_code=500,
-                content={"success": False, "error": "API Key missing"}
-            )
-        
-        genai.configure(api_key=api_key)
-        
-        prompt = f"""Parse this voice command for a medical prescription order system:
-"{request.text}"
+        result = await prescription_agent.process(await image.read())
+        return result
+    except Exception as e:
+        logger.error(f"Prescription parse error: {e}")
+        response.status_code = 500
+        return {"success": False, "error": str(e)}
 
-Return JSON with:
-{{
-    "intent": "add" | "remove" | "confirm" | "done" | "unknown",
-    "medication_name": "name or null",
-    "quantity": number or null,
-    "confidence": 0.8
-}}"""
-        
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        response = model.generate_content(prompt)
+@app.post("/api/voice/command", response_model=AgentResponse, response_model_exclude_unset=True)
+async def voice_command(request: VoiceCommandRequest, response: Response):
+    """Process voice commands for prescription ordering"""
+    try:
+        cache_key = ("voice-command", hashlib.sha256(request.text.encode()).hexdigest())
+        cached = parse_cache.get(cache_key)
+        if cached is not None:
+            return {
+                "success": True,
+                "data": cached
+            }
         
-        import json
-        result_text = response.text.strip()
-        if "```json" in result_text:
-            result_text = result_text.split("```json")[1].split("```")[0]
-        elif "```" in result_text:
-            result_text = result_text.split("```")[1].split("```")[0]
+        reply = await get_model(VOICE_COMMAND_SYSTEM_PROMPT).generate_content_async(request.text)
         
-        result = json.loads(result_text)
+        result = _parse_json_response_cached(reply.text)
+        parse_cache[cache_key] = result
         
-        return JSONResponse(content={
+        return {
             "success": True,
             "data": result
-        })
+        }
         
     except Exception as e:
         logger.error(f"Voice command error: {e}")
-        return JSONResponse(
-            status_code=500,
-            content={"success": False, "error": str(e)}
-        )
+        response.status_code = 500
+        return {"success": False, "error": str(e)}
 
 @app.get("/api/health")
-async def health_check():
+async def health_check() -> Dict[str, Any]:
     """Health check endpoint"""
     return {
         "status": "healthy",
@@ -472,4 +896,13 @@ async def health_check():
     }
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Multiple workers sidestep the GIL; each worker keeps its own caches.
+    # uvloop/httptools ship with uvicorn[standard] but uvloop has no Windows build.
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+    )
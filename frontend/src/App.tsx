@@ -33,6 +33,17 @@ const AGENTS = [
 
 const API_BASE_URL = (import.meta as any).env?.VITE_API_URL || 'http://localhost:8000';
 
+// History sent with each request: at most 10 messages, with old ones dropped in
+// blocks of 5 so the start of the prompt stays the same for several turns and
+// Gemini's prefix cache can hit (mirrors history_window in backend/app.py)
+const MAX_HISTORY_MSGS = 10;
+const HISTORY_TRIM_STEP = 5;
+
+const historyWindow = (msgs: Message[]): Message[] => {
+  const overflow = Math.max(0, msgs.length - MAX_HISTORY_MSGS);
+  return msgs.slice(Math.ceil(overflow / HISTORY_TRIM_STEP) * HISTORY_TRIM_STEP);
+};
+
 const App: React.FC = () => {
   const [messages, setMessages] = useState<Message[]>([
     {
@@ -149,7 +160,7 @@ const App: React.FC = () => {
         },
         body: JSON.stringify({
           message: userMessage.content,
-          history: messages.slice(-10).map(m => ({
+          history: historyWindow(messages).map(m => ({
             role: m.role,
             content: m.content,
             timestamp: m.timestamp.toISOString(),